@@ -1,22 +1,52 @@
 from fastapi import FastAPI, UploadFile, Form
 from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageDraw
 from paddleocr import PaddleOCR
-import io
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import asyncio
+import atexit
+import hashlib
+import os
+import queue
 import uvicorn
-import json
+import orjson
 import logging
+import logging.handlers
 
-# Configure logging
+# Configure logging. Handlers run on a background listener thread so request
+# handlers only pay for a queue put. The queue side only merges args into the
+# message; the listener's handler applies the real format.
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    handlers=[queue_handler]
 )
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Skribb AI OCR Service")
+@asynccontextmanager
+async def lifespan(app):
+    global batch_queue, ocr_engines_lock
+    batch_queue = asyncio.Queue()
+    ocr_engines_lock = asyncio.Lock()
+    if ocr_en:
+        await asyncio.get_running_loop().run_in_executor(ocr_executor, warm_up, ocr_en)
+    worker = asyncio.create_task(batch_worker())
+    yield
+    worker.cancel()
+
+app = FastAPI(title="Skribb AI OCR Service", lifespan=lifespan)
 
 # CORS
 app.add_middleware(
@@ -27,26 +57,242 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Inference backend; defaults to CPU fp32. Opt in to GPU with e.g.
+# OCR_DEVICE=gpu:0 OCR_USE_TENSORRT=1 OCR_PRECISION=fp16
+OCR_DEVICE = os.getenv("OCR_DEVICE", "cpu")
+OCR_USE_TENSORRT = os.getenv("OCR_USE_TENSORRT", "0") == "1"
+OCR_PRECISION = os.getenv("OCR_PRECISION", "fp32")
+
+def create_ocr(lang):
+    return PaddleOCR(
+        use_textline_orientation=True,
+        lang=lang,
+        device=OCR_DEVICE,
+        use_tensorrt=OCR_USE_TENSORRT,
+        precision=OCR_PRECISION,
+        show_log=False,
+    )
+
 # Initialize OCR engines (lazy loading could be better, but keeping it simple for now)
 try:
-    logger.info("Initializing English OCR engine...")
-    ocr_en = PaddleOCR(use_textline_orientation=True, lang='en', show_log=False)
+    logger.info(f"Initializing English OCR engine on {OCR_DEVICE}...")
+    ocr_en = create_ocr('en')
     logger.info("English OCR engine initialized.")
 except Exception as e:
     logger.error(f"Failed to initialize OCR engine: {e}")
     ocr_en = None
 
-def sanitize_for_json(obj):
+# Engines for other languages are loaded on first use. The most recently used
+# OCR_MAX_LANG_ENGINES are kept for later requests, since each holds a full model.
+OCR_MAX_LANG_ENGINES = int(os.getenv("OCR_MAX_LANG_ENGINES", "2"))
+ocr_engines = OrderedDict()
+ocr_engines_lock = None
+
+# PaddleOCR instances are not safe to share between threads, so all
+# inference goes through a single dedicated worker instead of the shared
+# Starlette threadpool. Paddle releases the GIL while the model runs.
+ocr_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ocr")
+
+# Concurrent requests are coalesced into one predict() call of up to
+# OCR_BATCH_SIZE images, waiting at most OCR_BATCH_WAIT_MS for the batch to fill.
+OCR_BATCH_SIZE = int(os.getenv("OCR_BATCH_SIZE", "8"))
+OCR_BATCH_WAIT = float(os.getenv("OCR_BATCH_WAIT_MS", "5")) / 1000
+batch_queue = None
+
+# LRU of recent results keyed by (lang, image hash), so retries and re-uploads
+# of the same image skip inference. Entries hold only what the handlers serve:
+# the recognized lines and the already-encoded raw_result JSON.
+OCR_CACHE_SIZE = int(os.getenv("OCR_CACHE_SIZE", "32"))
+ocr_cache = OrderedDict()
+
+# Images are downscaled to at most OCR_MAX_SIDE px on the long edge before
+# inference. When OCR_BLANK_THRESHOLD is set, pages whose Laplacian variance
+# (on a 128px thumbnail) falls below it are skipped as blank. Off by default:
+# sparse handwriting can score very low, so tune it on real scans first.
+OCR_MAX_SIDE = int(os.getenv("OCR_MAX_SIDE", "1600"))
+OCR_BLANK_THRESHOLD = float(os.getenv("OCR_BLANK_THRESHOLD", "0"))
+
+def json_default(obj):
+    # orjson serializes contiguous numpy arrays and scalars natively; this only
+    # sees arrays it can't (non-contiguous, odd dtypes) and unknown objects.
     if isinstance(obj, np.ndarray):
         return obj.tolist()
-    elif isinstance(obj, list):
-        return [sanitize_for_json(x) for x in obj]
-    elif isinstance(obj, dict):
-        return {k: sanitize_for_json(v) for k, v in obj.items()}
-    elif isinstance(obj, (str, int, float, bool)) or obj is None:
-        return obj
-    else:
-        return str(obj)
+    return str(obj)
+
+def dumps(obj):
+    return orjson.dumps(
+        obj,
+        default=json_default,
+        option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY,
+    )
+
+class OCRJSONResponse(JSONResponse):
+    def render(self, content):
+        return dumps(content)
+
+def is_blank(img):
+    small = img.copy()
+    small.thumbnail((128, 128))
+    tiny = np.asarray(small.convert("L"), dtype=np.float32)
+    laplacian = (tiny[:-2, 1:-1] + tiny[2:, 1:-1] + tiny[1:-1, :-2] + tiny[1:-1, 2:]
+                 - 4 * tiny[1:-1, 1:-1])
+    return laplacian.var() < OCR_BLANK_THRESHOLD
+
+def decode_image(image_file):
+    """
+    Decode and downscale an uploaded image file. Returns the pixel array (None
+    for a blank page) and the original and processed (width, height).
+    Blocking; call via run_in_threadpool.
+    """
+    img = Image.open(image_file)
+    original_size = img.size
+    # thumbnail() lets the JPEG decoder scale down while decoding
+    img.thumbnail((OCR_MAX_SIDE, OCR_MAX_SIDE), Image.BILINEAR)
+    image_size = {"original": list(original_size), "processed": list(img.size)}
+    if OCR_BLANK_THRESHOLD > 0 and is_blank(img):
+        logger.info("Skipping OCR for image detected as blank")
+        return None, image_size
+    return np.asarray(img), image_size
+
+async def get_ocr(lang):
+    key = lang.lower() if lang else 'en'
+    if key == 'en':
+        return ocr_en
+    async with ocr_engines_lock:
+        ocr = ocr_engines.get(key)
+        if ocr is None:
+            logger.info(f"Loading OCR for language: {lang}")
+            # Built on the OCR worker like all other PaddleOCR use
+            loop = asyncio.get_running_loop()
+            ocr = await loop.run_in_executor(ocr_executor, create_ocr, lang)
+            ocr_engines[key] = ocr
+        ocr_engines.move_to_end(key)
+        while len(ocr_engines) > OCR_MAX_LANG_ENGINES:
+            evicted, _ = ocr_engines.popitem(last=False)
+            logger.info(f"Unloading OCR for language: {evicted}")
+    return ocr
+
+def hash_image(image_file):
+    """
+    Hash an uploaded image file in chunks and rewind it. Blocking; call via run_in_threadpool.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for chunk in iter(lambda: image_file.read(1 << 20), b""):
+        digest.update(chunk)
+    image_file.seek(0)
+    return digest.hexdigest()
+
+def summarize(results, image_size):
+    """
+    Reduce predict() output to what the handlers serve, dropping image buffers.
+    """
+    return {
+        "lines": list(results[0]['rec_texts']) if results else [],
+        "raw_result": orjson.Fragment(dumps(results)),
+        "image_size": image_size,
+    }
+
+def cache_get(key):
+    entry = ocr_cache.get(key)
+    if entry is not None:
+        ocr_cache.move_to_end(key)
+    return entry
+
+def cache_put(key, entry):
+    ocr_cache[key] = entry
+    ocr_cache.move_to_end(key)
+    while len(ocr_cache) > OCR_CACHE_SIZE:
+        ocr_cache.popitem(last=False)
+
+def warm_up(ocr):
+    """
+    Run one throwaway prediction so engine build and shape collection (TensorRT
+    on GPU) happen at startup rather than on the first request.
+    """
+    img = Image.new("RGB", (640, 160), "white")
+    ImageDraw.Draw(img).text((20, 60), "Skribb AI warm-up", fill="black")
+    try:
+        ocr.predict(np.asarray(img))
+        logger.info("OCR engine warmed up.")
+    except Exception as e:
+        logger.error(f"OCR warm-up failed: {e}")
+
+def predict_batch(ocr, imgs):
+    """
+    Run one predict() over imgs, checking there is one result per image.
+    Blocking; runs on ocr_executor.
+    """
+    results = list(ocr.predict(imgs))
+    if len(results) != len(imgs):
+        raise RuntimeError(f"OCR returned {len(results)} results for {len(imgs)} images")
+    return results
+
+async def batch_worker():
+    """
+    Drain batch_queue and run each batch through a single predict() per engine.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await batch_queue.get()]
+        deadline = loop.time() + OCR_BATCH_WAIT
+        while len(batch) < OCR_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(batch_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        by_engine = {}
+        for ocr, img, future in batch:
+            by_engine.setdefault(ocr, []).append((img, future))
+
+        for ocr, items in by_engine.items():
+            try:
+                try:
+                    results = await loop.run_in_executor(ocr_executor, predict_batch, ocr, [img for img, _ in items])
+                except Exception as e:
+                    if len(items) == 1:
+                        raise
+                    # Retry one by one so a bad image only fails its own request
+                    logger.error(f"OCR batch of {len(items)} failed, retrying individually: {e}")
+                    results = []
+                    for img, future in items:
+                        if future.done():
+                            results.append(None)
+                            continue
+                        try:
+                            results.append((await loop.run_in_executor(ocr_executor, predict_batch, ocr, [img]))[0])
+                        except Exception as item_error:
+                            results.append(item_error)
+                for (_, future), result in zip(items, results):
+                    if future.done():
+                        continue
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+            # Never leave a request waiting on a result that will not come
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(RuntimeError("OCR returned no result for this image"))
+
+async def predict(ocr, image_file):
+    """
+    Decode an image and queue it for batched OCR. Returns predict()-style results
+    and the original/processed image sizes.
+    """
+    img, image_size = await run_in_threadpool(decode_image, image_file)
+    if img is None:
+        return [], image_size
+    future = asyncio.get_running_loop().create_future()
+    batch_queue.put_nowait((ocr, img, future))
+    return [await future], image_size
 
 @app.get("/health")
 async def health_check():
@@ -59,36 +305,38 @@ async def imagetotext(file: UploadFile, lang: str = Form(None)):
     """
     try:
         if not ocr_en:
-             return JSONResponse({"success": False, "error": "OCR engine not initialized"}, status_code=500)
+             return OCRJSONResponse({"success": False, "error": "OCR engine not initialized"}, status_code=500)
 
-        # Read image
-        image_bytes = await file.read()
-        img = np.array(Image.open(io.BytesIO(image_bytes)))
+        # Decode straight from the spooled upload instead of copying it into memory
+        image_file = file.file
+        cache_key = (lang.lower() if lang else 'en', await run_in_threadpool(hash_image, image_file))
 
-        # Choose OCR instance (currently only EN supported efficiently)
-        ocr = ocr_en
-        if lang and lang.lower() != 'en':
-             # Dynamic loading for other languages (might be slow)
-             logger.info(f"Loading OCR for language: {lang}")
-             ocr = PaddleOCR(use_textline_orientation=True, lang=lang, show_log=False)
+        entry = cache_get(cache_key)
+        if entry is None:
+            # Choose OCR instance (first request for a new language loads it, which is slow)
+            ocr = await get_ocr(lang)
 
-        # Run OCR
-        results = ocr.predict(img)
-        text_lines = results[0]['rec_texts'] if results else []
+            # Run OCR off the event loop
+            results, image_size = await predict(ocr, image_file)
+            entry = summarize(results, image_size)
+            # Blank-page skips return [] and are not cached
+            if results:
+                cache_put(cache_key, entry)
 
-        serializable_results = sanitize_for_json(results)
-        extracted_text = " ".join(text_lines)
+        extracted_text = " ".join(entry["lines"])
 
-        return JSONResponse({
+        return OCRJSONResponse({
             "success": True,
             "text": extracted_text,
-            "raw_result": serializable_results,
+            "raw_result": entry["raw_result"],
+            # raw_result coordinates are in the processed (downscaled) image
+            "image_size": entry["image_size"],
             "lang_used": lang if lang else "en"
         })
 
     except Exception as e:
         logger.error(f"Error in imagetotext: {e}")
-        return JSONResponse({
+        return OCRJSONResponse({
             "success": False,
             "error": str(e)
         }, status_code=500)
@@ -102,19 +350,23 @@ async def imagetotext_stream(file: UploadFile, lang: str = Form(None)):
         if not ocr_en:
              raise Exception("OCR engine not initialized")
 
-        image_bytes = await file.read()
-        img = np.array(Image.open(io.BytesIO(image_bytes)))
+        image_file = file.file
+        cache_key = (lang.lower() if lang else 'en', await run_in_threadpool(hash_image, image_file))
 
-        ocr = ocr_en
-        if lang and lang.lower() != 'en':
-             ocr = PaddleOCR(use_textline_orientation=True, lang=lang, show_log=False)
+        entry = cache_get(cache_key)
+        if entry is None:
+            ocr = await get_ocr(lang)
 
-        results = ocr.predict(img)
-        lines = results[0]['rec_texts'] if results else []
+            results, image_size = await predict(ocr, image_file)
+            entry = summarize(results, image_size)
+            # Blank-page skips return [] and are not cached
+            if results:
+                cache_put(cache_key, entry)
+        lines = entry["lines"]
 
         def event_generator():
             for line in lines:
-                yield f"data: {json.dumps({'text': line})}\n\n"
+                yield f"data: {orjson.dumps({'text': line}).decode()}\n\n"
             # Signal end
             yield "event: done\ndata: {}\n\n"
 
@@ -123,8 +375,9 @@ async def imagetotext_stream(file: UploadFile, lang: str = Form(None)):
     except Exception as e:
         logger.error(f"Error in imagetotext_stream: {e}")
         def error_gen():
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            yield f"data: {orjson.dumps({'error': str(e)}).decode()}\n\n"
         return StreamingResponse(error_gen(), media_type="text/event-stream")
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=1235)
\ No newline at end of file
+    # uvicorn[standard] picks up uvloop and httptools automatically where available
+    uvicorn.run(app, host="0.0.0.0", port=1235, access_log=False)
\ No newline at end of file